@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-from PyPDF2 import PdfWriter, PdfReader
+import pymupdf
 import argparse
 
 argParser = argparse.ArgumentParser()
@@ -14,10 +14,17 @@ argParser.add_argument(
 
 args = argParser.parse_args()
 
-inputpdf = PdfReader(open(args.input_pdf_path, "rb"))
+"""Open by filename, not from bytes, so that large PDFs are never read fully into memory"""
+inputpdf = pymupdf.open(filename=args.input_pdf_path)
 
-for i in range(len(inputpdf.pages)):
-    output = PdfWriter()
-    output.add_page(inputpdf.pages[i])
-    with open(f"{args.input_pdf_path}-{i}", "wb") as outputStream:
-        output.write(outputStream)
+try:
+    for i in range(inputpdf.page_count):
+        output = pymupdf.open()
+
+        try:
+            output.insert_pdf(inputpdf, from_page=i, to_page=i)
+            output.save(f"{args.input_pdf_path}-{i}")
+        finally:
+            output.close()
+finally:
+    inputpdf.close()
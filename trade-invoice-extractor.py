@@ -1,11 +1,29 @@
 #!/usr/bin/env python
-from PyPDF2 import PdfReader
+import pymupdf
 from enum import Enum
-import functools
 import re
 import datetime
 import csv
 import argparse
+import concurrent.futures
+import contextlib
+import glob
+import hashlib
+import operator
+import os
+import sys
+import pathlib
+import tempfile
+
+"""
+CACHE_FORMAT_VERSION
+
+The version of the rows of text stored in the text cache. Bump this whenever a change to readPDFRows or readRows changes 
+the rows extracted from a PDF, so that rows cached by older versions are not reused.
+"""
+
+CACHE_FORMAT_VERSION = "v1"
+
 
 """
 Vendor
@@ -24,6 +42,30 @@ __init__:
 
 
 class Vendor:
+    __slots__ = (
+        "name",
+        "dateFormat",
+        "itemRegex",
+        "itemNameOffsetIndex",
+        "unitsOffsetIndex",
+        "unitCostOffsetIndex",
+        "minOffsetIndex",
+        "maxSplit",
+        "itemFields",
+        "dateKey",
+        "itemPattern",
+        "datePattern",
+        "yearBase",
+        "dateDelim",
+        "dateRegex",
+        "iD",
+        "iM",
+        "iY",
+        "numD",
+        "numM",
+        "numY",
+    )
+
     def __init__(
         self,
         name,
@@ -40,9 +82,94 @@ class Vendor:
         self.unitsOffsetIndex = unitsOffsetIndex
         self.unitCostOffsetIndex = unitCostOffsetIndex
 
+        """Offsets are read backwards from the end of a line, so an offset past the end can never match an item"""
+        if max(itemNameOffsetIndex, unitsOffsetIndex, unitCostOffsetIndex) > 0:
+            raise ValueError(f"{name} item offset indexes must not be positive.")
+
+        self.minOffsetIndex = min(
+            itemNameOffsetIndex, unitsOffsetIndex, unitCostOffsetIndex
+        )
+
+        """
+        Only the words from the end of a line up to the furthest offset need splitting individually; everything before
+        them is kept as a single leading string.
+        """
+        self.maxSplit = 1 - self.minOffsetIndex
+
+        """
+        Given the words of a valid item line split with maxSplit, get the item name words, units, and unit cost. 
+
+        Every offset is read from the end of the line, so the index of the last word is always -1.
+        """
+        self.itemFields = operator.itemgetter(
+            slice(1, itemNameOffsetIndex - 1),
+            unitsOffsetIndex - 1,
+            unitCostOffsetIndex - 1,
+        )
+
+        self.prepareDateRegex()
+
+        """Compile vendor patterns once, rather than for every line of every order"""
+        self.itemPattern = re.compile(itemRegex)
+        self.datePattern = re.compile(self.dateRegex)
+
     def __str__(self):
         return f"{self.name}, {self.dateFormat}, {self.itemRegex}, {self.itemNameOffsetIndex}, {self.unitsOffsetIndex}, {self.unitCostOffsetIndex}"
 
+    """
+    Given the vendor date format, compile the regular expression and the index information needed to extract and normalise dates. 
+
+    Any date format with D or DD, M or MM, and YY or YYYY is supported in any order. 
+    
+    '/', '-', or '.' delimiting characters is supported. 
+    """
+
+    def prepareDateRegex(self):
+        self.yearBase = 0
+
+        self.dateDelim = re.search("[\/\-\.]", self.dateFormat).group()
+
+        """Transform the format string into a series of regex parts, then join to a single string"""
+        self.dateRegex = "".join(
+            "\\d" if char != self.dateDelim else "\\" + self.dateDelim
+            for char in self.dateFormat
+        )
+
+        self.iD = self.dateFormat.find("D")
+        self.iM = self.dateFormat.find("M")
+        self.iY = self.dateFormat.find("Y")
+
+        self.numD = len(self.dateFormat.split("D")) - 1
+        self.numM = len(self.dateFormat.split("M")) - 1
+        self.numY = len(self.dateFormat.split("Y")) - 1
+
+        """If a YY only year is provided, add the start of the current century back to get YYYY"""
+        if self.numY == 2:
+            self.yearBase = datetime.datetime.now().year // 100 * 100
+
+        """
+        Given a string matching the vendor date format, get the fixed-width year, month, and day strings, 
+        which compare in the same order as the dates themselves.
+        """
+        self.dateKey = operator.itemgetter(
+            slice(self.iY, self.iY + self.numY),
+            slice(self.iM, self.iM + self.numM),
+            slice(self.iD, self.iD + self.numD),
+        )
+
+    """
+    Given a string matching the vendor date format, normalise it to a datetime.
+
+    Raises a ValueError if the string is not a valid date, e.g. 31/02/2023.
+    """
+
+    def parseDate(self, d):
+        return datetime.datetime(
+            self.yearBase + int(d[self.iY : self.iY + self.numY]),
+            int(d[self.iM : self.iM + self.numM]),
+            int(d[self.iD : self.iD + self.numD]),
+        )
+
 
 """
 Item
@@ -57,6 +184,10 @@ __init__:
 
 
 class Item:
+    """Items are created for every matched invoice line, so avoid a per-instance __dict__"""
+
+    __slots__ = ("name", "units", "unitCost", "total")
+
     def __init__(self, name, units, unitCost):
         self.name = name
         self.units = int(units)
@@ -83,17 +214,21 @@ __init__:
 class Order:
     def __init__(self, vendor, pdfPath):
         self.date = None
+        self.dateString = None
         self.items = []
-        self.textLines = []
 
         self.vendor = vendor
         self.pfdPath = pdfPath
 
         self.readPDF()
 
-        self.extractDate()
+        """Preserve the behaviour of max() over an empty sequence if no date was found"""
+        if self.dateString is None:
+            raise ValueError(
+                f"No {self.vendor.dateFormat} date found in {self.pfdPath}"
+            )
 
-        self.extractItems()
+        self.date = self.vendor.parseDate(self.dateString)
 
     def __str__(self):
         orderString = (
@@ -106,164 +241,246 @@ class Order:
         return orderString
 
     """
-    Given a PDF path, extract lines of text from a PDF and save to self.
+    Given a PDF path, stream rows of text from a PDF into the item and date extractors.
 
-    The function splits PDF file text by lines, as each item on an order invoice is usually stored in a table-like structure with one item 
-    corresponding to one row. 
+    The function splits PDF file text by rows, as each item on an order invoice is usually stored in a table-like structure with one item 
+    corresponding to one row. Each row is scanned once, as it is read, so the full text of the PDF is never held in memory.
 
     TODO: Accept a wider format of PDF structures to ensure all items are captured from various vendors. 
     """
 
     def readPDF(self):
-        reader = PdfReader(self.pfdPath)
+        """Bind the per-line lookups once, rather than for every line of the PDF"""
+        findItem = self.vendor.itemPattern.search
+        findDates = self.vendor.datePattern.findall
+        maxSplit = self.vendor.maxSplit
+        minOffsetIndex = self.vendor.minOffsetIndex
+        itemFields = self.vendor.itemFields
+        dateKey = self.vendor.dateKey
+        extractItem = self.extractItem
+
+        latestDateKey = None
+
+        for line in self.readLines():
+            """
+            Keep the latest date string seen so far as the date of the order. Dates are compared by their fixed-width
+            year, month, and day strings, so that a datetime is only built for the latest date.
+
+            As a result, an invalid date-shaped string, e.g. 31/02/2023, is only detected if it is the latest date,
+            when parsing it raises a ValueError. Otherwise it is ignored.
+            """
+            for d in findDates(line):
+                key = dateKey(d)
+
+                if latestDateKey is None or key > latestDateKey:
+                    latestDateKey = key
+                    self.dateString = d
+
+            if findItem(line):
+                words = line.rsplit(" ", maxSplit)
 
-        for i in range(len(reader.pages)):
-            self.textLines += reader.pages[i].extract_text().splitlines()
+                """
+                Read from the end of the array backwards, since we dont know how long
+                the name of each item is, but we know the relative positions of all other item data
+                """
+                offsetStart = len(words) - 1
+
+                """
+                Use the vendor's specific PDF layout and the number of words in the line to make a good-faith guess as to 
+                wether a real item has been matched. The Vendor guarantees that no offset points past the end of a line, so a 
+                line is only invalid if the furthest offset points before the start of the line.
 
+                TODO: Give a more concrete check of validity.
+                """
+                if offsetStart + minOffsetIndex >= 0:
+                    extractItem(words[0], *itemFields(words))
+
+    """
+    Find the path of the text cache for the PDF, keyed by a hash of the PDF file contents. 
+
+    The cache lives in $XDG_CACHE_HOME/trade-invoice-extractor, or ~/.cache/trade-invoice-extractor if unset or not absolute, 
+    under a directory for the current CACHE_FORMAT_VERSION.
     """
-    Given a list of strings (lines from a PDF), use a regular expression to extract lines based on item codes. 
 
-    Check to see that the match is a valid match that specific vendor. 
+    def getCachePath(self):
+        sha1 = hashlib.sha1()
+
+        with open(self.pfdPath, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                sha1.update(chunk)
+
+        """An unset, empty, or relative XDG_CACHE_HOME is ignored, as required by the XDG Base Directory spec"""
+        cacheDir = pathlib.Path(os.environ.get("XDG_CACHE_HOME") or "")
+
+        if not cacheDir.is_absolute():
+            cacheDir = pathlib.Path("~/.cache").expanduser()
+
+        return (
+            cacheDir
+            / "trade-invoice-extractor"
+            / CACHE_FORMAT_VERSION
+            / f"{sha1.hexdigest()}.txt"
+        )
 
-    Apply normalistation to the item values to give a regular shape to the Item object.
+    """
+    Yield the rows of text from the PDF. 
 
-    Store a list of Items in self. 
+    If the same PDF has been read before, the rows are read back from the text cache and the PDF is not parsed at all. Otherwise, 
+    the rows are written to a temporary file as they are read, which replaces the cache file once the whole PDF has been read, 
+    so that an interrupted read or a parallel worker never leaves a partial cache file behind.
 
+    The cache is only an optimisation, so if it cannot be read or written the PDF is parsed without it.
     """
 
-    def extractItems(self):
-        for i in range(len(self.textLines)):
-            match = re.search(self.vendor.itemRegex, self.textLines[i])
+    def readLines(self):
+        cachePath = self.getCachePath()
 
-            if match:
-                words = self.textLines[i].split(" ")
+        try:
+            cache = open(cachePath, encoding="utf-8")
+        except OSError:
+            cache = None
 
-                """
-                Read from the end of the array backwards, since we dont know how long
-                the name of each item is, but we know the relative positions of all other item data
-                """
-                offsetStart = len(words) - 1
+        if cache is not None:
+            with cache:
+                for line in cache:
+                    yield line.rstrip("\n")
+
+            return
 
-                if self.isValidItem(offsetStart):
-                    name = " ".join(
-                        words[1 : offsetStart + self.vendor.itemNameOffsetIndex]
-                    )
+        try:
+            cachePath.parent.mkdir(parents=True, exist_ok=True)
 
-                    units = words[offsetStart + self.vendor.unitsOffsetIndex]
+            cacheFile = tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", dir=cachePath.parent, suffix=".tmp", delete=False
+            )
+        except OSError:
+            cacheFile = None
+
+        try:
+            for line in self.readPDFRows():
+                if cacheFile is not None:
+                    try:
+                        cacheFile.write(line + "\n")
+                    except OSError:
+                        self.discardCacheFile(cacheFile)
 
-                    unitCostParts = words[
-                        offsetStart + self.vendor.unitCostOffsetIndex
-                    ].split(".")
+                        cacheFile = None
 
-                    """Enforce a strict cost shape of *.00"""
-                    if len(unitCostParts) > 1:
-                        unitCost = unitCostParts[0] + "." + unitCostParts[1][0:2]
+                yield line
 
-                        self.items.append(Item(name, units, unitCost))
+            if cacheFile is not None:
+                try:
+                    cacheFile.close()
 
+                    os.replace(cacheFile.name, cachePath)
+                except OSError:
+                    pass
+        finally:
+            if cacheFile is not None:
+                self.discardCacheFile(cacheFile)
+
+    """
+    Close and remove a temporary cache file which will not, or could not, replace the cache file.
     """
-    Given a date format, extract and normalise the date of the order. 
 
-    Any date format with D or DD, M or MM, and YY or YYYY is supported in any order. 
-    
-    '/', '-', or '.' delimiting characters is supported. 
+    def discardCacheFile(self, cacheFile):
+        with contextlib.suppress(OSError):
+            cacheFile.close()
+
+        with contextlib.suppress(OSError):
+            os.remove(cacheFile.name)
+
+    """
+    Yield the rows of text from each page of the PDF, skipping pages which hold no text.
     """
 
-    def extractDate(self):
-        dates = []
-        yearPrefix = ""
+    def readPDFRows(self):
+        """Open by filename, not from bytes, so that MuPDF only reads the parts of the file it needs"""
+        doc = pymupdf.open(filename=self.pfdPath)
 
-        dateDelim = re.search("[\/\-\.]", self.vendor.dateFormat).group()
+        try:
+            for page in doc:
+                """
+                Pages which reference no fonts, such as scanned images, hold no text, so skip them before
+                paying for text extraction
+                """
+                if not page.get_fonts():
+                    continue
 
-        """Transform the format string into a series of regex parts, then reduce to a single string"""
-        regexParts = map(
-            lambda char: "\d" if char != dateDelim else f"\{dateDelim}",
-            self.vendor.dateFormat,
-        )
-        regex = functools.reduce(lambda s, c: s + c, regexParts)
+                yield from self.readRows(page)
+        finally:
+            doc.close()
 
-        iD = self.vendor.dateFormat.find("D")
-        iM = self.vendor.dateFormat.find("M")
-        iY = self.vendor.dateFormat.find("Y")
+    """
+    Given a PDF page, rebuild each visual row of text from the positions of its words. 
 
-        numD = len(self.vendor.dateFormat.split("D")) - 1
-        numM = len(self.vendor.dateFormat.split("M")) - 1
-        numY = len(self.vendor.dateFormat.split("Y")) - 1
+    Table cells are often stored as separate blocks of text, so a single item row can be broken over several lines by plain 
+    text extraction. Grouping words which share a baseline, to within half a word height, and ordering them left to right 
+    gives one line per table row, with words separated by single spaces.
+    """
 
-        """If a YY only year is provided, add the start of the year back to get YYYY"""
-        if numY == 2:
-            yearPrefix = str(datetime.datetime.now().year)[0:2]
+    def readRows(self, page):
+        rows = []
+        rowBottom = None
 
-        """
-        Generated an array of datetime objects based on a regex search for the given date format 
-        for all lines
-        """
-        for line in self.textLines:
-            dates += map(
-                lambda d: datetime.datetime(
-                    int(yearPrefix + d[iY : iY + numY]),
-                    int(d[iM : iM + numM]),
-                    int(d[iD : iD + numD]),
-                ),
-                re.findall(regex, line),
-            )
+        for x0, y0, x1, y1, word, *_ in sorted(
+            page.get_text("words"), key=lambda w: (w[3], w[0])
+        ):
+            if rowBottom is None or y1 - rowBottom > (y1 - y0) / 2:
+                rows.append([])
+                rowBottom = y1
 
-        self.date = max(dates)
+            rows[-1].append((x0, word))
+
+        return [" ".join(word for x0, word in sorted(row)) for row in rows]
 
     """
-    Use a vendor's specific PDF layout and the number of words in a matching PDF line to make a good-faith guess as to wether a 
-    real item has been matched by the item regular expression. 
+    Given the fields of a valid item line from a PDF, apply normalistation to the item values to give a regular shape to the Item object.
 
-    Given we expect an extracted line to have a known number of words in a vendor-specific fashion, we can use the offset values to 
-    attempt to verify the validity of the extracted line. 
+    Store the Item in self. 
 
-    TODO: Update this function to give a more concrete check of validity. 
     """
 
-    def isValidItem(self, offsetStart):
-        if (offsetStart + self.vendor.itemNameOffsetIndex) < 0:
-            return False
-
-        if (offsetStart + self.vendor.itemNameOffsetIndex) > offsetStart:
-            return False
+    def extractItem(self, head, nameWords, units, unitCost):
+        """The first word holds the item code, followed by the start of the item name on long lines"""
+        code, sep, nameStart = head.partition(" ")
 
-        if (offsetStart + self.vendor.unitsOffsetIndex) < 0:
-            return False
+        if sep:
+            nameWords.insert(0, nameStart)
 
-        if (offsetStart + self.vendor.unitsOffsetIndex) > offsetStart:
-            return False
+        name = " ".join(nameWords)
 
-        if (offsetStart + self.vendor.unitCostOffsetIndex) < 0:
-            return False
+        unitCostParts = unitCost.split(".")
 
-        if (offsetStart + self.vendor.unitCostOffsetIndex) > offsetStart:
-            return False
+        """Enforce a strict cost shape of *.00"""
+        if len(unitCostParts) > 1:
+            unitCost = unitCostParts[0] + "." + unitCostParts[1][0:2]
 
-        return True
+            self.items.append(Item(name, units, unitCost))
 
     """
-    Add extracted order items to a given CSV, appending to the file. 
+    Build a CSV row for each extracted order item.
 
     The format of each row is defined to allow copy-paste to a personal spreadsheet, but 
     the format can be easily adjusted to suit.
 
     """
 
+    def getCSVRows(self):
+        date = self.date.strftime("%d/%m/%Y")
+
+        return [
+            (self.vendor.name, "", date, item.name, item.units, item.unitCost)
+            for item in self.items
+        ]
+
+    """
+    Add extracted order items to a given CSV, appending to the file in a single write of all rows. 
+    """
+
     def appendItemsToCSV(self, csvPath):
         with open(csvPath, "a", newline="") as file:
-            writer = csv.writer(file)
-
-            for item in self.items:
-                writer.writerow(
-                    [
-                        self.vendor.name,
-                        "",
-                        self.date.strftime("%d/%m/%Y"),
-                        item.name,
-                        item.units,
-                        item.unitCost,
-                    ]
-                )
+            csv.writer(file).writerows(self.getCSVRows())
 
 
 """
@@ -282,6 +499,20 @@ class VendorList(Enum):
     )
 
 
+"""
+extractCSVRows
+
+Given a vendor name from the VendorList and the path to a PDF file, instantiate a new Order and return its CSV rows. 
+
+Used as the unit of work when extracting a batch of PDFs in parallel, so that only the rows are passed back to the 
+parent process and all writes to the CSV file happen in one place.
+"""
+
+
+def extractCSVRows(vendorName, pdfPath):
+    return Order(VendorList[vendorName].value, pdfPath).getCSVRows()
+
+
 """
 PDFFileType
 
@@ -290,7 +521,7 @@ Defines and enforces a .pdf file extension as an argument type.
 
 
 def PDFFileType(v):
-    if re.search("\.pdf$", v) is None:
+    if not v.lower().endswith(".pdf"):
         raise argparse.ArgumentTypeError(f"{v} must be a .pdf file.")
 
     return v
@@ -304,7 +535,7 @@ Defines and enforces a .csv file extension as an argument type.
 
 
 def CSVFileType(v):
-    if re.search("\.csv$", v) is None:
+    if not v.lower().endswith(".csv"):
         raise argparse.ArgumentTypeError(f"{v} must be a .csv file.")
 
     return v
@@ -313,44 +544,103 @@ def CSVFileType(v):
 """
 Main - trade-invoice-extractor.py
 
-Define and parse a vendor, input_pdf, and output_csv arguments. 
+Define and parse a vendor, input_pdf or input_dir, and output_csv arguments. 
 
 Then, for the given vendor, instantiate a new Order from the provided PDF and append the 
 Order to a CSV file.
 
+For an input_dir, every matching PDF is extracted in parallel across CPU cores, and the items of
+each Order are appended to the CSV file in path order. Any PDF which fails is reported and skipped, 
+and the script exits with an error once the rest of the batch has been written.
+
 """
 
-argParser = argparse.ArgumentParser()
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
 
-argParser.add_argument(
-    "-v",
-    "--vendor",
-    type=str,
-    required=True,
-    choices=["SCREWFIX", "TOOLSTATION"],
-    help="The vendor of the invoice. Defines the search and structure of the item extraction.",
-)
+    argParser.add_argument(
+        "-v",
+        "--vendor",
+        type=str,
+        required=True,
+        choices=["SCREWFIX", "TOOLSTATION"],
+        help="The vendor of the invoice. Defines the search and structure of the item extraction.",
+    )
+
+    inputGroup = argParser.add_mutually_exclusive_group(required=True)
+
+    inputGroup.add_argument(
+        "-i",
+        "--input_pdf",
+        type=PDFFileType,
+        help="The path to the input PDF file.",
+    )
+
+    inputGroup.add_argument(
+        "-d",
+        "--input_dir",
+        type=str,
+        help="A directory of input PDF files, or a glob pattern matching input PDF files.",
+    )
+
+    argParser.add_argument(
+        "-o",
+        "--output_csv",
+        type=CSVFileType,
+        required=True,
+        help="The path to the output CSV file",
+    )
+
+    args = argParser.parse_args()
+
+    if args.input_pdf:
+        vendor = VendorList[args.vendor].value
+
+        order = Order(vendor, args.input_pdf)
+
+        order.appendItemsToCSV(args.output_csv)
+    else:
+        pattern = args.input_dir
+
+        if os.path.isdir(pattern):
+            paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            paths = glob.glob(pattern)
+
+        """Only keep files with a .pdf extension, matched without case as for input_pdf"""
+        pdfPaths = sorted(
+            path
+            for path in paths
+            if path.lower().endswith(".pdf") and os.path.isfile(path)
+        )
+
+        if not pdfPaths:
+            argParser.error(f"no PDF files found for {args.input_dir}")
+
+        failedPaths = []
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count()
+        ) as executor, open(args.output_csv, "a", newline="") as file:
+            writer = csv.writer(file)
 
-argParser.add_argument(
-    "-i",
-    "--input_pdf",
-    type=PDFFileType,
-    required=True,
-    help="The path to the input PDF file.",
-)
+            """Submit each PDF on its own, so that a failure in one PDF does not stop the rest of the batch"""
+            futures = [
+                executor.submit(extractCSVRows, args.vendor, pdfPath)
+                for pdfPath in pdfPaths
+            ]
 
-argParser.add_argument(
-    "-o",
-    "--output_csv",
-    type=CSVFileType,
-    required=True,
-    help="The path to the output CSV file",
-)
+            for pdfPath, future in zip(pdfPaths, futures):
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    print(f"Failed to extract {pdfPath}: {e}", file=sys.stderr)
 
-args = argParser.parse_args()
+                    failedPaths.append(pdfPath)
 
-vendor = VendorList[args.vendor].value
+                    continue
 
-order = Order(vendor, args.input_pdf)
+                writer.writerows(rows)
 
-order.appendItemsToCSV(args.output_csv)
+        if failedPaths:
+            sys.exit(f"{len(failedPaths)} of {len(pdfPaths)} PDF files failed.")